@@ -225,11 +225,11 @@ def read_config(args):
                                   simulated_frequency_optimization=True)
     for key in DEFAULT_CONFIG:
         if key not in answer.adict:
-            answer.adict[key] = DEFAULT_CONFIG[key]
+            setattr(answer, key, DEFAULT_CONFIG[key])
     if args.config_values is not None:
         for cv in args.config_values.split(';'):
             name, value = cv.split('=')
-            answer.adict[name] = eval(value)
+            setattr(answer, name, eval(value))
     answer.validate()
     logging.info('Using config: %s', json.dumps(answer.as_dict(), indent=4))
     return answer
@@ -7,8 +7,12 @@ import argparse
 import bisect
 import cProfile
 import collections
+import concurrent.futures
+import contextlib
 import csv
+import functools
 import gzip
+import heapq
 import itertools
 import json
 import logging
@@ -17,6 +21,7 @@ import os
 import os.path
 import random
 import re
+import shutil
 import string
 import subprocess as subp
 import sys
@@ -40,7 +45,6 @@ from keras.layers import TimeDistributed, Flatten, Conv1D, recurrent, Embedding
 import keras.utils
 from keras.callbacks import TensorBoard
 
-from sklearn.utils import shuffle
 import numpy as np
 import tensorflow as tf
 from enum import IntEnum
@@ -58,6 +62,8 @@ FNAME_PREFIX_PROCESS_LOG = 'log.child_process.'
 FNAME_PREFIX_PROCESS_OUT = 'out.child_process.'
 
 MEMORY_ONLY = ':memory:'
+# Coarsest modification time resolution assumed for the intermediate file
+INTERMEDIATE_MTIME_SLACK_NS = 100 * 1000 * 1000
 
 class Sequence(IntEnum):
     MANY_TO_ONE = 0
@@ -87,6 +93,31 @@ class CharacterTable():
         self.padding_character = padding_character
         self.embedding = embedding
         self.sequence_model = sequence_model
+        self.char_index_table = self.make_char_index_table()
+
+    def make_char_index_table(self):
+        # Maps the latin-1 ordinal of a character to its index so that whole
+        # strings can be encoded with a single numpy lookup. Characters that
+        # are not in the table map to -1.
+        table = np.full(256, -1, dtype=np.int16)
+        for c, i in self.char_indices.items():
+            if ord(c) < len(table):
+                table[ord(c)] = i
+        return table
+
+    def string_indices(self, astring):
+        try:
+            codes = np.frombuffer(astring.encode('latin-1'), dtype=np.uint8)
+        except UnicodeEncodeError:
+            codes = None
+        if codes is not None:
+            indices = self.char_index_table[codes]
+            if (indices >= 0).all():
+                return indices
+        # Slow path for characters outside of latin-1. Raises KeyError for
+        # unknown characters.
+        return np.array([self.char_indices[c] for c in astring],
+                        dtype=np.int16)
 
     def pad_to_len(self, astring, maxlen=None):
         maxlen = maxlen if maxlen else self.maxlen
@@ -96,17 +127,40 @@ class CharacterTable():
             return astring + (PASSWORD_END * (maxlen - len(astring)))
         return astring
 
-    def encode_many(self, string_list, maxlen=None, y_vec=False):
+    def encode_many(self, string_list, maxlen=None, y_vec=False, out=None):
         # maxlen = maxlen if maxlen else 40 # self.maxlen
         maxlen = maxlen if maxlen else self.maxlen
-        x_str_list = map(lambda x: self.pad_to_len(x, maxlen), string_list)
-        if self.embedding and not y_vec:
-            x_vec = np.zeros(shape=(len(string_list), maxlen), dtype=np.int8)
+        # Only truncate here; padding is written directly into x_vec below
+        x_str_list = [x[-maxlen:] for x in string_list]
+        if out is not None:
+            # Reuse the leading rows of a buffer from an earlier call
+            x_vec = out[:len(x_str_list)]
+            x_vec.fill(0)
+        elif self.embedding and not y_vec:
+            x_vec = np.zeros(shape=(len(x_str_list), maxlen), dtype=np.int8)
         else:
-            x_vec = np.zeros((len(string_list), maxlen, self.vocab_size),
+            x_vec = np.zeros((len(x_str_list), maxlen, self.vocab_size),
                          dtype=np.bool)
-        for i, xstr in enumerate(x_str_list):
-            self.encode_into(x_vec[i], xstr)
+        # Encode all of the strings at once: look up the indices of the
+        # concatenated strings and scatter them into (row, column) positions.
+        lengths = np.fromiter(map(len, x_str_list), dtype=np.intp,
+                              count=len(x_str_list))
+        rows = np.repeat(np.arange(len(x_str_list)), lengths)
+        cols = np.arange(len(rows)) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        indices = self.string_indices(''.join(x_str_list))
+        if len(x_vec.shape) == 2:
+            x_vec[rows, cols] = indices
+        else:
+            x_vec[rows, cols, indices] = True
+        if self.padding_character:
+            padding = np.arange(maxlen) >= lengths[:, np.newaxis]
+            if padding.any():
+                end_idx = self.char_indices[PASSWORD_END]
+                if len(x_vec.shape) == 2:
+                    x_vec[padding] = end_idx
+                else:
+                    x_vec[padding, end_idx] = True
         return x_vec
 
     def encode_many_chunks(self, string_list, max_input_str_len, maxlen=None, y_vec=False):
@@ -127,17 +181,17 @@ class CharacterTable():
         return self.encode_many(chunks_str_list, maxlen, y_vec=y_vec), chunks_str_list
 
     def y_encode_into(self, Y, C):
-        for i, c in enumerate(C):
-            Y[i, self.char_indices[c]] = 1
+        # Each item of C is a single character
+        Y[np.arange(len(C)), self.string_indices(''.join(C))] = 1
 
     def encode_into(self, X, C):
-        for i, c in enumerate(C):
-            if len(X.shape) == 1:
-                X[i] = self.char_indices[c]
-            elif len(X.shape) == 2:
-                X[i, self.char_indices[c]] = 1
-            else:
-                raise Exception("Code should never reach here, dimension of X can only be 1 or 2")
+        indices = self.string_indices(C)
+        if len(X.shape) == 1:
+            X[:len(indices)] = indices
+        elif len(X.shape) == 2:
+            X[np.arange(len(indices)), indices] = 1
+        else:
+            raise Exception("Code should never reach here, dimension of X can only be 1 or 2")
 
     def encode(self, C, maxlen=None):
         maxlen = maxlen if maxlen else self.maxlen
@@ -210,6 +264,7 @@ class OptimizingCharacterTable(CharacterTable):
         super().__init__(char_bag, maxlen, embedding, padding_character)
         for key in self.rare_dict:
             self.char_indices[key] = self.char_indices[self.rare_dict[key]]
+        self.char_index_table = self.make_char_index_table()
         translate_table = {}
         for c in chars:
             if c in self.rare_dict:
@@ -375,6 +430,9 @@ class ModelDefaults():
         self.adict = adict if adict is not None else dict()
         for k in kwargs:
             self.adict[k] = kwargs[k]
+        # Mirror the configured values as instance attributes so that
+        # reading them is a plain attribute lookup
+        self.__dict__.update(self.adict)
 
         if self.context_length is None:
             self.context_length = self.max_len
@@ -382,15 +440,24 @@ class ModelDefaults():
         if isinstance(self.sequence_model, str):
             self.sequence_model = Sequence[self.sequence_model]
 
-        self._read_intermediate_data_time = None
+        self._intermediate_data_signature = None
+        self._intermediate_data_time_ns = 0
         self._intermediate_data = self._read_intermediate_data()
 
+    def _intermediate_file_signature(self):
+        try:
+            stat = os.stat(self.intermediate_fname)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
     def _read_intermediate_data(self):
-        self._read_intermediate_data_time = time.time()
         if self.intermediate_fname == MEMORY_ONLY:
             return {}
 
-        if not os.path.exists(self.intermediate_fname):
+        self._intermediate_data_time_ns = time.time_ns()
+        self._intermediate_data_signature = self._intermediate_file_signature()
+        if self._intermediate_data_signature is None:
             return {}
 
         with open(self.intermediate_fname, 'r') as info:
@@ -405,33 +472,34 @@ class ModelDefaults():
         if self.intermediate_fname == MEMORY_ONLY:
             return
 
-        self._read_intermediate_data_time = time.time()
+        # json.dump issues one write per token; serialize up front instead
+        info_as_str = json.dumps(self._intermediate_data, indent=2)
+        self._intermediate_data_time_ns = time.time_ns()
         with open(self.intermediate_fname, 'w') as info:
-            json.dump(self._intermediate_data, info, indent=2)
+            info.write(info_as_str)
+        # Remember our own write so that the next read does not reparse it
+        self._intermediate_data_signature = self._intermediate_file_signature()
 
     def _check_if_should_reload(self):
         if self.intermediate_fname == MEMORY_ONLY:
             return
 
-        if not os.path.exists(self.intermediate_fname):
+        signature = self._intermediate_file_signature()
+        if signature is None:
             return
-
-        mod_time = os.path.getmtime(self.intermediate_fname)
-        assert self._read_intermediate_data_time is not None
-        if mod_time >= self._read_intermediate_data_time:
+        # A write landing in the same timestamp tick as our last access may
+        # leave the signature unchanged, so recent files are always reread
+        if (signature != self._intermediate_data_signature or
+                signature[0] + INTERMEDIATE_MTIME_SLACK_NS >=
+                self._intermediate_data_time_ns):
             self._intermediate_data = self._read_intermediate_data()
 
-    def __getattribute__(self, name):
-        if name != 'adict' and name in self.adict:
-            return self.adict[name]
-
-        return super().__getattribute__(name)
-
     def __setattr__(self, name, value):
+        # Configured values must be set as attributes rather than through
+        # adict directly so that the instance attributes stay in sync
         if name != 'adict' and not name.startswith("_"):
             self.adict[name] = value
-        else:
-            super().__setattr__(name, value)
+        super().__setattr__(name, value)
 
     @staticmethod
     def fromFile(afile):
@@ -501,7 +569,11 @@ class ModelDefaults():
                 and not isinstance(value, staticmethod))}
 
     def set_intermediate_info(self, key, value):
-        self._intermediate_data[key] = value
+        self.update_intermediate_info({key : value})
+
+    def update_intermediate_info(self, adict):
+        # Sets several keys while rewriting the intermediate file only once
+        self._intermediate_data.update(adict)
         self._write_intermediate_data()
 
     def get_intermediate_info(self, key):
@@ -520,7 +592,8 @@ class ModelDefaults():
                 continue
             key, _, value = keyval.partition('=')
             answer[key] = type(getattr(self, key))(value)
-        self.adict.update(answer)
+        for key, value in answer.items():
+            setattr(self, key, value)
 
     def sequence_model_updates(self):
         if self.sequence_model == Sequence.MANY_TO_MANY:
@@ -571,29 +644,30 @@ class Preprocessor(BasePreprocessor):
         self.pwd_whole_list = None
         self.pwd_freqs = None
         self.chunked_pwd_list = None
+        self._pwd_order = None
 
     def begin(self, pwd_list):
         self.pwd_whole_list = list(pwd_list)
+        self._pwd_order = None
 
     def begin_resetable(self, resetable):
         self.resetable_pwd_list = resetable
         self.reset()
 
-    def all_prefixes(self, pwd):
-        return [pwd[:i] for i in range(len(pwd))] + [pwd]
-
-    def all_suffixes(self, pwd):
-        return [pwd[i] for i in range(len(pwd))] + [PASSWORD_END]
-
-    def repeat_weight(self, pwd):
-        return [self.password_weight(pwd) for _ in range(len(pwd) + 1)]
-
     def train_from_pwds(self, pwd_tuples):
+        # Builds every (prefix, next character, weight) example in a single
+        # pass, looking up each password's weight only once
         self.pwd_freqs = dict(pwd_tuples)
-        pwds = list(map(lambda x: x[0], pwd_tuples))
-        return (itertools.chain.from_iterable(map(self.all_prefixes, pwds)),
-                itertools.chain.from_iterable(map(self.all_suffixes, pwds)),
-                itertools.chain.from_iterable(map(self.repeat_weight, pwds)))
+        prefixes, suffixes, weights = [], [], []
+        for pwd_tuple in pwd_tuples:
+            pwd = pwd_tuple[0]
+            num_examples = len(pwd) + 1
+            prefixes.extend(pwd[:i] for i in range(num_examples))
+            suffixes.extend(pwd)
+            suffixes.append(PASSWORD_END)
+            weights.extend(
+                itertools.repeat(self.password_weight(pwd), num_examples))
+        return prefixes, suffixes, weights
 
     def next_chunk(self):
         if self.chunk * self.config.training_chunk >= len(self.pwd_whole_list):
@@ -606,13 +680,15 @@ class Preprocessor(BasePreprocessor):
             self.begin(new_iterator)
             self.reset_subiterator()
             return self.next_chunk()
-        pwd_list = self.pwd_whole_list[
-            self.chunk * self.config.training_chunk:
-            min((self.chunk + 1) * self.config.training_chunk,
-                len(self.pwd_whole_list))]
+        start = self.chunk * self.config.training_chunk
+        end = min(start + self.config.training_chunk, len(self.pwd_whole_list))
+        if self._pwd_order is None:
+            pwd_list = self.pwd_whole_list[start:end]
+        else:
+            pwd_list = [self.pwd_whole_list[i]
+                        for i in self._pwd_order[start:end].tolist()]
         self.chunk += 1
-        pwd_input, output, weight = self.train_from_pwds(pwd_list)
-        return (list(pwd_input), list(output), list(weight))
+        return self.train_from_pwds(pwd_list)
 
     def password_weight(self, pwd):
         if isinstance(pwd, tuple):
@@ -642,7 +718,9 @@ class Preprocessor(BasePreprocessor):
     def reset_subiterator(self):
         self.chunk = 0
         if self.config.randomize_training_order:
-            random.shuffle(self.pwd_whole_list)
+            # Shuffle an index array in C rather than swapping the
+            # password tuples one at a time
+            self._pwd_order = np.random.permutation(len(self.pwd_whole_list))
 
 
 class Trainer():
@@ -673,12 +751,14 @@ class Trainer():
 
     def next_train_set_as_np(self):
         x_strs, y_str_list, weight_list = self.pwd_list.next_chunk()
-        x_vec = self.prepare_x_data(x_strs)
-        y_vec = self.prepare_y_data(y_str_list)
-        weight_vec = np.zeros((len(weight_list)))
-        for i, weight in enumerate(weight_list):
-            weight_vec[i] = weight
-        return shuffle(x_vec, y_vec, weight_vec)
+        # Shuffle the examples before encoding them so that the encoded
+        # arrays never need to be copied into a new order
+        order = np.random.permutation(len(x_strs)).tolist()
+        x_vec = self.prepare_x_data([x_strs[i] for i in order])
+        y_vec = self.prepare_y_data([y_str_list[i] for i in order])
+        weight_vec = np.array([weight_list[i] for i in order],
+                              dtype=np.float64)
+        return x_vec, y_vec, weight_vec
 
     def prepare_x_data(self, x_strs):
         return self.ctable.encode_many(x_strs)
@@ -852,55 +932,68 @@ class Trainer():
             stop = True
         return stop
 
+    def _prefetched_train_sets(self):
+        # Prepare the next chunk on a background thread while the model
+        # trains on the current one
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            next_set = executor.submit(self.next_train_set_as_np)
+            while True:
+                train_set = next_set.result()
+                if len(train_set[0]) == 0:
+                    return
+                next_set = executor.submit(self.next_train_set_as_np)
+                yield train_set
+
     def train_model_generation(self, serializer=None):
         if self.config.early_stopping:
             assert serializer, "Need to specify serializer with early_stopping"
         self.chunk = 0
         self.pwd_list.reset()
         accuracy_accum = []
-        x_all, y_all, w_all = self.next_train_set_as_np()
         chunk = 0
         early_stop = False
-        while len(x_all) != 0:
-            assert len(x_all) == len(y_all)
-            tr_loss, tr_acc, te_loss, te_acc = self.training_step(
-                x_all, y_all, w_all)
-            accuracy_accum += [(len(x_all), te_acc)]
-            self.smoothened_loss.append((len(x_all), te_loss))
-            if self.config.tensorboard:
-                self.write_log(self.train_log_names, [tr_loss, tr_acc], self.cumulative_chunks)
-                self.write_log(self.test_log_names, [te_loss, te_acc], self.cumulative_chunks)
-
-            if chunk % self.config.chunk_print_interval == 0:
-                #Finding weighted average to get the right loss value over batches
-                # of unequal sizes
-                instances_smoothened = map(lambda x: x[0], self.smoothened_loss)
-                loss_smoothened = sum(map(lambda x: x[0] * x[1], self.smoothened_loss)
-                                      ) / sum(instances_smoothened)
-                logging.info('Chunk %s. Each chunk is size %s',
-                             chunk, len(x_all))
-                logging.info('Train loss %s. Test loss %s. Test accuracy %s. Averaged loss %s',
-                             tr_loss, te_loss, te_acc, loss_smoothened)
+        # Closing the generator shuts down its prefetch thread on early
+        # stopping and on errors too
+        with contextlib.closing(self._prefetched_train_sets()) as train_sets:
+            for x_all, y_all, w_all in train_sets:
+                assert len(x_all) == len(y_all)
+                tr_loss, tr_acc, te_loss, te_acc = self.training_step(
+                    x_all, y_all, w_all)
+                accuracy_accum += [(len(x_all), te_acc)]
+                self.smoothened_loss.append((len(x_all), te_loss))
                 if self.config.tensorboard:
-                    self.callback.writer.flush()
-
-            if self.config.early_stopping and \
-                    self.cumulative_chunks >= self.config.early_stopping_patience and \
-                self.cumulative_chunks % self.config.chunk_print_interval == 0:
-                #Second condition so that the model doesn't start saving \
-                # very early in the training process
-                #Third condition to prevent evaluation of accuracy too frequently
-                instances_smoothened = map(lambda x: x[0], self.smoothened_loss)
-                loss_smoothened = sum(map(lambda x: x[0] * x[1], self.smoothened_loss)
-                                      ) / sum(instances_smoothened)
-                early_stop = self.early_stopping(loss_smoothened, serializer)
-                if early_stop:
-                    instances = map(lambda x: x[0], accuracy_accum)
-                    return sum(map(lambda x: x[0] * x[1], accuracy_accum)
-                               ) / sum(instances), early_stop
-            x_all, y_all, w_all = self.next_train_set_as_np()
-            chunk += 1
-            self.cumulative_chunks += 1
+                    self.write_log(self.train_log_names, [tr_loss, tr_acc], self.cumulative_chunks)
+                    self.write_log(self.test_log_names, [te_loss, te_acc], self.cumulative_chunks)
+
+                if chunk % self.config.chunk_print_interval == 0:
+                    #Finding weighted average to get the right loss value over batches
+                    # of unequal sizes
+                    instances_smoothened = map(lambda x: x[0], self.smoothened_loss)
+                    loss_smoothened = sum(map(lambda x: x[0] * x[1], self.smoothened_loss)
+                                          ) / sum(instances_smoothened)
+                    logging.info('Chunk %s. Each chunk is size %s',
+                                 chunk, len(x_all))
+                    logging.info('Train loss %s. Test loss %s. Test accuracy %s. Averaged loss %s',
+                                 tr_loss, te_loss, te_acc, loss_smoothened)
+                    if self.config.tensorboard:
+                        self.callback.writer.flush()
+
+                if self.config.early_stopping and \
+                        self.cumulative_chunks >= self.config.early_stopping_patience and \
+                    self.cumulative_chunks % self.config.chunk_print_interval == 0:
+                    #Second condition so that the model doesn't start saving \
+                    # very early in the training process
+                    #Third condition to prevent evaluation of accuracy too frequently
+                    instances_smoothened = map(lambda x: x[0], self.smoothened_loss)
+                    loss_smoothened = sum(map(lambda x: x[0] * x[1], self.smoothened_loss)
+                                          ) / sum(instances_smoothened)
+                    early_stop = self.early_stopping(loss_smoothened, serializer)
+                    if early_stop:
+                        instances = map(lambda x: x[0], accuracy_accum)
+                        return sum(map(lambda x: x[0] * x[1], accuracy_accum)
+                                   ) / sum(instances), early_stop
+                chunk += 1
+                self.cumulative_chunks += 1
         instances = map(lambda x: x[0], accuracy_accum)
         return sum(map(lambda x: x[0] * x[1], accuracy_accum)) / sum(instances), early_stop
 
@@ -980,28 +1073,23 @@ class ManyToManyTrainer(Trainer):
 
         return model
 
-    def next_train_set_as_np(self):
-        x_strs, y_str_list, weight_list = self.pwd_list.next_chunk()
-        x_vec = self.prepare_x_data(x_strs)
-        y_vec = self.prepare_y_data(y_str_list)
-        weight_vec = np.zeros((len(weight_list)))
-        for i, weight in enumerate(weight_list):
-            weight_vec[i] = weight
-        return shuffle(x_vec, y_vec, weight_vec)
-
     def prepare_y_data(self, y_str_list):
         y_vec = self.ctable.encode_many(y_str_list, y_vec=True)
         return y_vec
 
 class ManyToManyPreprocessor(Preprocessor):
-    def all_prefixes(self, pwd):
-        return [PASSWORD_START + pwd]
-
-    def all_suffixes(self, pwd):
-        return [pwd + PASSWORD_END]
+    def train_from_pwds(self, pwd_tuples):
+        self.pwd_freqs = dict(pwd_tuples)
+        pwds = [pwd_tuple[0] for pwd_tuple in pwd_tuples]
+        return ([PASSWORD_START + pwd for pwd in pwds],
+                [pwd + PASSWORD_END for pwd in pwds],
+                [self.password_weight(pwd) for pwd in pwds])
 
-    def repeat_weight(self, pwd):
-        return [self.password_weight(pwd)]
+@functools.lru_cache(maxsize=None)
+def parse_hex_frequency(freq):
+    # Password frequencies repeat heavily, so each distinct string is only
+    # parsed once
+    return float.fromhex(freq)
 
 class PwdList():
     class NoListTypeException(Exception):
@@ -1061,7 +1149,7 @@ class TsvListParent(PwdList):
             return None, None
         try:
             if self.freq_format_hex:
-                value = float.fromhex(row[1])
+                value = parse_hex_frequency(row[1])
             else:
                 value = int(row[1])
         except ValueError as e:
@@ -1071,17 +1159,22 @@ class TsvListParent(PwdList):
             return None, None
         return row[0], int(value)
 
+    @staticmethod
+    def split_rows(agen):
+        # Rows are never quoted, so a plain split does what csv.reader did
+        for line in agen:
+            yield line.rstrip('\n').split('\t')
+
 class TsvList(TsvListParent):
     def as_list_iter(self, agen):
-        for row in csv.reader(iter(agen), delimiter='\t', quotechar=None):
+        for row in self.split_rows(agen):
             pwd, freq = self.interpret_row(row)
             if pwd is not None:
-                for _ in range(freq):
-                    yield (pwd, 1)
+                yield from itertools.repeat((pwd, 1), freq)
 
 class TsvSimulatedList(TsvListParent):
     def as_list_iter(self, agen):
-        for row in csv.reader(iter(agen), delimiter='\t', quotechar=None):
+        for row in self.split_rows(agen):
             pwd, value = self.interpret_row(row)
             if pwd is not None:
                 yield (pwd, value)
@@ -1154,11 +1247,15 @@ class ConcatenatingList():
         return itertools.chain.from_iterable(answer)
 
 class Filterer():
+    # Number of accepted passwords to buffer before counting their characters
+    FREQUENCY_BATCH_SIZE = 10000
+
     def __init__(self, config, uniquify=False):
         self.filtered_out = 0
         self.total = 0
         self.total_characters = 0
-        self.frequencies = collections.defaultdict(int)
+        self._frequencies = collections.defaultdict(int)
+        self._uncounted_pwds = []
         self.beg_frequencies = collections.defaultdict(int)
         self.end_frequencies = collections.defaultdict(int)
         self.config = config
@@ -1167,6 +1264,7 @@ class Filterer():
         if config.sequence_model == Sequence.MANY_TO_MANY:
             # Replace so that you don't accept passwords with tab character in them
             self.char_bag = self.char_bag.replace("\t", "")
+        self.char_bag_set = frozenset(self.char_bag)
         self.max_len = config.max_len
         self.min_len = config.min_len
         self.uniquify = uniquify
@@ -1177,13 +1275,29 @@ class Filterer():
         for c in pwd:
             adict[c] += 1
 
+    @property
+    def frequencies(self):
+        self._count_uncounted_pwds()
+        return self._frequencies
+
+    def _count_uncounted_pwds(self):
+        # Counting the characters of many passwords joined together lets
+        # Counter do the per-character work in C
+        if not self._uncounted_pwds:
+            return
+        counts = collections.Counter(''.join(self._uncounted_pwds))
+        for c, count in counts.items():
+            self._frequencies[c] += count
+        self._uncounted_pwds = []
+
     def pwd_is_valid(self, pwd, quick=False):
         if isinstance(pwd, tuple):
             pwd = ''.join(pwd)
         pwd = pwd.strip(PASSWORD_END)
-        answer = (all(map(lambda c: c in self.char_bag, pwd)) and
-                  len(pwd) <= self.max_len and
-                  len(pwd) >= self.min_len)
+        pwd_len = len(pwd)
+        # The length check is cheaper, so it runs before the character scan
+        answer = (self.min_len <= pwd_len <= self.max_len and
+                  self.char_bag_set.issuperset(pwd))
         if self.uniquify:
             if pwd in self.seen:
                 answer = False
@@ -1192,14 +1306,16 @@ class Filterer():
         if quick:
             return answer
         if answer:
-            self.total_characters += len(pwd)
-            Filterer.inc_frequencies(self.frequencies, pwd)
+            self.total_characters += pwd_len
+            self._uncounted_pwds.append(pwd)
+            if len(self._uncounted_pwds) >= self.FREQUENCY_BATCH_SIZE:
+                self._count_uncounted_pwds()
             Filterer.inc_frequencies(self.beg_frequencies, pwd[0])
             Filterer.inc_frequencies(self.end_frequencies, pwd[-1])
         else:
             self.filtered_out += 1
         self.total += 1
-        self.longest_pwd = max(self.longest_pwd, len(pwd))
+        self.longest_pwd = max(self.longest_pwd, pwd_len)
         return answer
 
     def rare_characters(self):
@@ -1218,23 +1334,23 @@ class Filterer():
         for key in self.frequencies:
             char_freqs[key] = self.frequencies[key] / self.total_characters
 
+        intermediate_info = {}
         if save_stats:
             # print('save stats is True', file=sys.stderr)
-            self.config.set_intermediate_info(
-                'rare_character_bag', self.rare_characters())
-            # print(self.config.get_intermediate_info('rare_character_bag'), file=sys.stderr)
+            intermediate_info['rare_character_bag'] = self.rare_characters()
             logging.info('Rare characters: %s', self.rare_characters())
             logging.info('Longest pwd is : %s characters long',
                          self.longest_pwd)
         else:
             print('donot save stats', file=sys.stderr)
         if save_freqs:
-            self.config.set_intermediate_info(
-                'character_frequencies', self.frequencies)
-            self.config.set_intermediate_info(
-                'beginning_character_frequencies', self.beg_frequencies)
-            self.config.set_intermediate_info(
-                'end_character_frequencies', self.end_frequencies)
+            intermediate_info['character_frequencies'] = self.frequencies
+            intermediate_info['beginning_character_frequencies'] = (
+                self.beg_frequencies)
+            intermediate_info['end_character_frequencies'] = (
+                self.end_frequencies)
+        if intermediate_info:
+            self.config.update_intermediate_info(intermediate_info)
 
     def filter(self, alist, quick=False):
         return filter(lambda x: self.pwd_is_valid(x[0], quick=quick), alist)
@@ -1286,8 +1402,7 @@ class GuessSerializer():
         return self.total_guessed
 
     def collect_answer(self, real_output, istream):
-        for line in istream:
-            real_output.write(line)
+        shutil.copyfileobj(istream, real_output)
 
     def finish_collecting(self, real_output):
         logging.info('Finishing aggregating child output')
@@ -1354,10 +1469,9 @@ class GuessNumberGenerator(GuessSerializer):
     def write_to_file(self, ostream, total_count, get_freq):
         ostream.write(self.TOTAL_COUNT_FORMAT % total_count)
         writer = csv.writer(ostream, delimiter='\t', quotechar=None)
-        for i in range(len(self.pwds), 0, -1):
-            idx = i - 1
-            writer.writerow([
-                self.pwds[idx], self.probs[idx], get_freq(idx)])
+        writer.writerows(
+            (self.pwds[idx], self.probs[idx], get_freq(idx))
+            for idx in range(len(self.pwds) - 1, -1, -1))
         ostream.flush()
 
     def finish_collecting(self, real_output):
@@ -1430,11 +1544,12 @@ class ProbabilityCalculator():
         self.preproc.begin(pwd_list)
         x_strings, y_strings, _ = self.preproc.next_chunk()
         while len(x_strings) != 0:
-            y_indices = list(map(self.ctable.get_char_index, y_strings))
-            probs = self._cached_batch_prob(x_strings)
+            # Each y string is a single character
+            y_indices = self.ctable.string_indices(''.join(y_strings))
+            probs = np.asarray(self._cached_batch_prob(x_strings))
             assert len(probs) == len(x_strings)
-            for i, y_idx in enumerate(y_indices):
-                prob = probs[i][0][y_idx].item()
+            y_probs = probs[np.arange(len(y_indices)), 0, y_indices].tolist()
+            for i, prob in enumerate(y_probs):
                 yield x_strings[i], y_strings[i], prob
 
             x_strings, y_strings, _ = self.preproc.next_chunk()
@@ -1570,24 +1685,27 @@ class PasswordTemplateSerializer(DelegatingSerializer):
                     char, pwd[i], i == 0, i == (len(template) - 1))
         return prob
 
-    def recursive_helper(self, cur_template, cur_pwd, cur_prob):
+    def recursive_helper(self, template, cur_pwd, cur_prob, idx=0):
         if cur_prob < self.lower_probability_threshold:
             return
-        if len(cur_template) == 0:
+        # Walk the template by index instead of slicing off one character per
+        # call, and copy runs of characters without preimages all at once.
+        run_start = idx
+        while idx < len(template) and template[idx] not in self.preimage:
+            idx += 1
+        if idx != run_start:
+            cur_pwd += ''.join(template[run_start:idx])
+        if idx == len(template):
             self.serializer.serialize(cur_pwd, cur_prob)
             return
-        if cur_template[0] in self.preimage:
-            preimages = self.preimage[cur_template[0]]
-            for c in preimages:
-                recur_pwd = cur_pwd + c
-                self.recursive_helper(
-                    cur_template[1:], recur_pwd,
-                    cur_prob * self.calc(cur_template[0], c,
-                                         len(cur_pwd) == 0,
-                                         len(cur_template) == 1))
-        else:
+        template_char = template[idx]
+        for c in self.preimage[template_char]:
             self.recursive_helper(
-                cur_template[1:], cur_pwd + cur_template[0], cur_prob)
+                template, cur_pwd + c,
+                cur_prob * self.calc(template_char, c,
+                                     idx == 0,
+                                     idx == len(template) - 1),
+                idx + 1)
 
     def serialize(self, pwd_template, prob):
         self.recursive_helper(pwd_template, '', prob)
@@ -1755,8 +1873,14 @@ class Guesser():
         self._calc_prob_cache = None
         self.should_make_guesses_rare_char_optimizer = (
             self._should_make_guesses_rare_char_optimizer())
-        self.output_serializer = self.make_serializer()
         self.pwd_end_idx = self.chars_list.index(PASSWORD_END)
+        # Index of PASSWORD_END in the model output. Subclasses may point
+        # pwd_end_idx at a different character list, so keep this separate.
+        self._ctable_end_idx = self.ctable.get_char_index(PASSWORD_END)
+        self.end_only_prediction = np.zeros(len(self.chars_list))
+        self.end_only_prediction[self._ctable_end_idx] = 1
+        self._encode_buffer = None
+        self.output_serializer = self.make_serializer()
 
     def read_test_passwords(self):
         logging.info('Reading password calculator test set...')
@@ -1829,32 +1953,42 @@ class Guesser():
 
         return answer
 
-    def relevel_prediction(self, preds, astring):
+    def _is_max_len(self, astring):
         if isinstance(astring, tuple):
-            astring_joined_len = sum(map(len, astring))
-        else:
-            astring_joined_len = 0
-        if not self.filterer.pwd_is_valid(astring, quick=True):
-            preds[self.ctable.get_char_index(PASSWORD_END)] = 0
-        elif len(astring) == self.max_len or (
-                isinstance(astring, tuple) and
-                astring_joined_len == self.max_len):
-            multiply = np.zeros(len(preds))
-            pwd_end_idx = self.ctable.get_char_index(PASSWORD_END)
-            multiply[pwd_end_idx] = 1
-            preds[pwd_end_idx] = 1
-            preds = np.multiply(preds, multiply, preds)
-
-        sum_per = sum(preds)
-        for i, v in enumerate(preds):
-            preds[i] = v / sum_per
+            return (len(astring) == self.max_len or
+                    sum(map(len, astring)) == self.max_len)
+        return len(astring) == self.max_len
 
     def relevel_prediction_many(self, pred_list, str_list):
-        if (self.filterer.pwd_is_valid(str_list[0], quick=True) and
-            len(str_list[0]) != self.max_len):
+        # Masks are computed for every row, so prefixes of different lengths
+        # may share a batch
+        invalid = np.array([not self.filterer.pwd_is_valid(astring, quick=True)
+                            for astring in str_list], dtype=bool)
+        max_len = np.array([self._is_max_len(astring)
+                            for astring in str_list], dtype=bool) & ~invalid
+        relevel = invalid | max_len
+        if not relevel.any():
             return
-        for i, pred_item in enumerate(pred_list):
-            self.relevel_prediction(pred_item[0], str_list[i])
+        preds = pred_list[:, 0]
+        preds[invalid, self._ctable_end_idx] = 0
+        preds[max_len] = self.end_only_prediction
+        preds[relevel] /= preds[relevel].sum(axis=1, keepdims=True)
+
+    def _encode_prefixes(self, astring_list):
+        if (self._encode_buffer is None or
+                len(self._encode_buffer) < len(astring_list)):
+            self._encode_buffer = self.ctable.encode_many(astring_list)
+            return self._encode_buffer
+        return self.ctable.encode_many(astring_list, out=self._encode_buffer)
+
+    def _predict(self, x_vec):
+        # predict_on_batch skips the batching loop and progress callbacks that
+        # predict sets up on every call
+        if len(x_vec) <= self.chunk_size_guesser:
+            return self.model.predict_on_batch(x_vec)
+        return np.concatenate([
+            self.model.predict_on_batch(x_vec[i:i + self.chunk_size_guesser])
+            for i in range(0, len(x_vec), self.chunk_size_guesser)])
 
     def conditional_probs(self, astring):
         return self.conditional_probs_many([astring])[0][0].copy()
@@ -1863,13 +1997,9 @@ class Guesser():
         if self.config.sequence_model == Sequence.MANY_TO_MANY:
             predict_strings, astring_list = self.ctable.encode_many_chunks(astring_list,
                                                                            self.config.max_len)
-            answer = self.model.predict(predict_strings,
-                                    verbose=0,
-                                    batch_size=self.chunk_size_guesser)
+            answer = self._predict(predict_strings)
         else:
-            answer = self.model.predict(self.ctable.encode_many(astring_list),
-                                    verbose=0,
-                                    batch_size=self.chunk_size_guesser)
+            answer = self._predict(self._encode_prefixes(astring_list))
         # pylint: disable=no-member
         #
         # numpy does have the float64 datatype
@@ -1887,29 +2017,6 @@ class Guesser():
             self.relevel_prediction_many(answer, astring_list)
         return answer
 
-    def next_nodes(self, astring, prob, prediction):
-        total_preds = prediction * prob
-        if len(astring) + 1 > self.max_len:
-            prob_end = total_preds[self.pwd_end_idx]
-            if prob_end >= self.lower_probability_threshold:
-                self.output_serializer.serialize(astring, prob_end)
-                self.generated += 1
-            return []
-        indexes = np.arange(len(total_preds))
-        above_cutoff = total_preds >= self.lower_probability_threshold
-        above_indices = indexes[above_cutoff]
-        probs_above = total_preds[above_cutoff]
-        answer = []
-        for i, chain_prob in enumerate(probs_above):
-            char = self.chars_list[above_indices[i]]
-            if char == PASSWORD_END:
-                self.output_serializer.serialize(astring, chain_prob)
-                self.generated += 1
-            else:
-                chain_pass = astring + char
-                answer.append((chain_pass, chain_prob))
-        return answer
-
     def batch_prob(self, prefixes):
         if len(prefixes) > self.max_gpu_prediction_size:
             if self.config.sequence_model == Sequence.MANY_TO_MANY:
@@ -1929,22 +2036,41 @@ class Guesser():
     def _extract_pwd_from_node(self, node_list):
         return map(lambda x: x[0], node_list)
 
-    def super_node_recur(self, node_list):
-        if len(node_list) == 0:
-            return
+    def _child_batches(self, node_list):
         pwds_list = list(self._extract_pwd_from_node(node_list))
         predictions = self.batch_prob(pwds_list)
+        # Expand prefixes only until a batch is full, so that each level of
+        # the depth first search holds about one batch of children and
+        # guesses are written in the same order as expanding node by node
         node_batch = []
-        for i, cur_node in enumerate(node_list):
-            astring, prob = cur_node
-            for next_node in self.next_nodes(astring, prob, predictions[i][0]):
-                node_batch.append(next_node)
-                if len(node_batch) == self.chunk_size_guesser:
-                    self.super_node_recur(node_batch)
-                    node_batch = []
-        if len(node_batch) > 0:
-            self.super_node_recur(node_batch)
-            node_batch = []
+        start = 0
+        while start < len(node_list) or len(node_batch) > 0:
+            # pylint: disable=I1101
+            # generator has this field
+            start = generator.expand_nodes(
+                self, node_list, predictions, node_batch, start,
+                self.chunk_size_guesser)
+            if len(node_batch) >= self.chunk_size_guesser:
+                yield node_batch[:self.chunk_size_guesser]
+                node_batch = node_batch[self.chunk_size_guesser:]
+            elif start == len(node_list):
+                if len(node_batch) > 0:
+                    yield node_batch
+                return
+
+    def super_node_recur(self, node_list):
+        # Depth first expansion using an explicit stack of batch generators
+        # rather than recursion. Every batch holds prefixes of the same
+        # length and is predicted with a single call to the model.
+        if len(node_list) == 0:
+            return
+        stack = [self._child_batches(node_list)]
+        while stack:
+            node_batch = next(stack[-1], None)
+            if node_batch is None:
+                stack.pop()
+            else:
+                stack.append(self._child_batches(node_batch))
 
     def _recur(self, astring='', prob=1):
         self.super_node_recur([(astring, prob)])
@@ -1970,8 +2096,7 @@ class Guesser():
     def calculate_probs(self):
         logging.info('Calculating probabilities only')
         writer = csv.writer(self.ostream, delimiter='\t', quotechar=None)
-        for pwd, prob in self._calculate_probs_from_file_sorted():
-            writer.writerow([pwd, prob])
+        writer.writerows(self._calculate_probs_from_file_sorted())
         self.ostream.flush()
         self.ostream.close()
 
@@ -2024,8 +2149,7 @@ class Guesser():
             self.read_guess_number_cache_from_file(
                 self.config.previous_probability_mapping_file),
             self._calculate_probs_from_file_sorted())
-        for pwd, prob, guess_number in answer:
-            writer.writerow([pwd, prob, guess_number])
+        writer.writerows(answer)
 
         self.ostream.flush()
         self.ostream.close()
@@ -2050,6 +2174,28 @@ class Guesser():
         return _predictor
 
 
+class BestFirstGuesser(Guesser):
+    """Expands the most probable prefixes first.
+
+    Prefixes wait on a heap ordered by probability and the most probable
+    chunk_size_guesser of them are predicted together, whatever their
+    lengths. The whole frontier is kept in memory, so this uses more memory
+    than the depth first Guesser.
+    """
+
+    def super_node_recur(self, node_list):
+        heap = [(-prob, astring) for astring, prob in node_list]
+        heapq.heapify(heap)
+        while heap:
+            node_batch = [heapq.heappop(heap) for _ in range(
+                min(self.chunk_size_guesser, len(heap)))]
+            node_batch = [(astring, -neg_prob)
+                          for neg_prob, astring in node_batch]
+            for child_batch in self._child_batches(node_batch):
+                for astring, prob in child_batch:
+                    heapq.heappush(heap, (-prob, astring))
+
+
 class RandomWalkSerializer(GuessSerializer):
     def serialize(self, password, prob):
         self.total_guessed += 1
@@ -2316,8 +2462,7 @@ class DelAmicoCalculator(GuessSerializer):
     def finish(self):
         logging.info('Guessed %s passwords', self.get_total_guessed())
         writer = csv.writer(self.ostream, delimiter='\t', quotechar=None)
-        for item in self.get_stats():
-            writer.writerow(item)
+        writer.writerows(self.get_stats())
         self.ostream.flush()
         self.ostream.close()
 
@@ -2331,7 +2476,12 @@ class GuesserBuilder():
         'generate_random' : RandomGenerator,
     }
 
-    other_class_builders = {}
+    other_class_builders = {
+        'best_first' : BestFirstGuesser,
+    }
+
+    # Guess output is written one short line at a time, so use a large buffer
+    OUTPUT_BUFFER_SIZE = 1 << 20
 
     def __init__(self, config):
         self.config = config
@@ -2353,7 +2503,7 @@ class GuesserBuilder():
         return self
 
     def add_file(self, ofname):
-        self.add_stream(open(ofname, 'w'))
+        self.add_stream(open(ofname, 'w', buffering=self.OUTPUT_BUFFER_SIZE))
         self.ofile_path = ofname
         return self
 
@@ -2361,7 +2511,8 @@ class GuesserBuilder():
         intm_dir = self.config.guesser_intermediate_directory
         handle, path = tempfile.mkstemp(dir=intm_dir)
         self.ofile_path = path
-        return self.add_stream(os.fdopen(handle, 'w'))
+        return self.add_stream(
+            os.fdopen(handle, 'w', buffering=self.OUTPUT_BUFFER_SIZE))
 
     def build(self):
         model_or_serializer = self.model
@@ -2409,7 +2560,7 @@ def init_logging(args):
         logging.critical('Uncaught exception', exc_info=(exctype, value, tb))
         sys.stderr.write('Uncaught exception!\n %s\n' % (value))
     sys.excepthook = except_hook
-    sys.setcheckinterval = 1000
+    sys.setswitchinterval(0.05)
     log_format = '%(asctime)-15s %(levelname)s: %(message)s'
     log_level = log_level_map[args['log_level']]
     if args['log_file']:
@@ -37,6 +37,42 @@ def next_nodes_random_walk(
                      conditional_predictions[index])
     return answer
 
+def expand_nodes(
+        self, list node_list, np.ndarray[np.double_t, ndim = 3] predictions,
+        list answer, Py_ssize_t start = 0, Py_ssize_t max_children = -1):
+    # Appends the children of node_list[start:] to answer, stopping after the
+    # node that brings answer to max_children. Returns the index of the next
+    # node to expand.
+    cdef double lower_probability_threshold = self.lower_probability_threshold
+    cdef int pwd_end_idx = self.pwd_end_idx
+    cdef int max_len = self.max_len
+    cdef list chars_list = self.chars_list
+    cdef str astring
+    cdef double prob, chain_prob
+    cdef int i
+    cdef Py_ssize_t j = start
+    while j < len(node_list):
+        if max_children >= 0 and len(answer) >= max_children:
+            break
+        astring, prob = node_list[j]
+        j += 1
+        if len(astring) + 1 > max_len:
+            chain_prob = predictions[j - 1, 0, pwd_end_idx] * prob
+            if chain_prob >= lower_probability_threshold:
+                self.output_serializer.serialize(astring, chain_prob)
+                self.generated += 1
+            continue
+        for i in range(predictions.shape[2]):
+            chain_prob = predictions[j - 1, 0, i] * prob
+            if chain_prob < lower_probability_threshold:
+                continue
+            if i == pwd_end_idx:
+                self.output_serializer.serialize(astring, chain_prob)
+                self.generated += 1
+            else:
+                answer.append((astring + chars_list[i], chain_prob))
+    return j
+
 def next_nodes_random_walk_tuple(
         self, tuple astring, double prob,
         np.ndarray[np.double_t, ndim = 1] prediction):
@@ -68,6 +68,13 @@ class CharacterTableTest(unittest.TestCase):
         self.assertEqual(ctable.translate('aba'), 'aba')
         self.assertEqual(ctable.translate('aba'), 'aba')
 
+    def test_encode_many_out(self):
+        ctable = pwd_guess.CharacterTable('ab', 2)
+        buf = ctable.encode_many(['aa', 'bb', 'ab'])
+        answer = ctable.encode_many(['ba'], out=buf)
+        np.testing.assert_array_equal(answer, ctable.encode_many(['ba']))
+        np.testing.assert_array_equal(buf[:1], answer)
+
     def test_embedding(self):
         ctable = pwd_guess.CharacterTable('ab', 2, embedding=True)
         np.testing.assert_array_equal(
@@ -105,6 +112,17 @@ class CharacterTableTest(unittest.TestCase):
                                                         [0, 0, 0, 1], [0, 1, 1, 1]]))
         self.assertListEqual(strings, ['abca', 'cabc', 'aaab', 'abbb'] )
 
+    def test_encode_many_non_latin(self):
+        ctable = pwd_guess.CharacterTable('a€', 2)
+        np.testing.assert_array_equal(
+            ctable.encode_many(['a€', '€']),
+            np.array([[[True, False],
+                       [False, True]],
+                      [[False, True],
+                       [False, False]]]))
+        with self.assertRaises(KeyError):
+            ctable.encode_many(['ab'])
+
 class OptimizingTableTest(unittest.TestCase):
     def test_table(self):
         ctable = pwd_guess.OptimizingCharacterTable('abcd', 2, 'ab', False)
@@ -269,6 +287,40 @@ class TrainerTest(unittest.TestCase):
         t.model = mock_model
         self.assertEqual((0.5, False), t.train_model_generation())
 
+    def make_prefetch_trainer(self, config):
+        pre = pwd_guess.Preprocessor(config)
+        pre.begin([('pass', 1), ('word', 1), ('abc', 1)])
+        t = pwd_guess.Trainer(pre, config=config)
+        mock_model = Mock()
+        mock_model.train_on_batch = MagicMock(return_value = (0.5, 0.5))
+        mock_model.test_on_batch = MagicMock(return_value = (0.5, 0.5))
+        t.model = mock_model
+        train_sets = []
+        prefetch = t._prefetched_train_sets
+        def tracked_prefetch():
+            train_sets.append(prefetch())
+            return train_sets[-1]
+        t._prefetched_train_sets = tracked_prefetch
+        return t, train_sets
+
+    def test_prefetch_closed_early_stop(self):
+        config = pwd_guess.ModelDefaults(
+            max_len = 5, training_chunk = 1, chunk_print_interval = 1,
+            early_stopping = True, early_stopping_patience = 0)
+        t, train_sets = self.make_prefetch_trainer(config)
+        self.assertEqual((0.5, True), t.train_model_generation(Mock()))
+        self.assertEqual(t.model.train_on_batch.call_count, 2)
+        # A closed generator has left its executor block
+        self.assertIsNone(train_sets[0].gi_frame)
+
+    def test_prefetch_closed_error(self):
+        config = pwd_guess.ModelDefaults(max_len = 5, training_chunk = 1)
+        t, train_sets = self.make_prefetch_trainer(config)
+        t.model.train_on_batch = MagicMock(side_effect = ValueError)
+        with self.assertRaises(ValueError):
+            t.train_model_generation()
+        self.assertIsNone(train_sets[0].gi_frame)
+
     def test_train_model(self):
         config = pwd_guess.ModelDefaults(max_len = 5, generations = 20)
         config.sequence_model = pwd_guess.Sequence.MANY_TO_ONE
@@ -461,6 +513,18 @@ class ModelDefaultsTest(unittest.TestCase):
                 intermediate_fname = intermediate_file.name)
             self.assertEqual(m.get_intermediate_info('test'), 8)
 
+    def test_update_intermediate_files(self):
+        with tempfile.NamedTemporaryFile(dir=TMPDIR) as intermediate_file:
+            m = pwd_guess.ModelDefaults(
+                intermediate_fname = intermediate_file.name)
+            m.set_intermediate_info('test', 8)
+            m.update_intermediate_info({'test2' : 9, 'test3' : [1]})
+            m = pwd_guess.ModelDefaults(
+                intermediate_fname = intermediate_file.name)
+            self.assertEqual(m.get_intermediate_info('test'), 8)
+            self.assertEqual(m.get_intermediate_info('test2'), 9)
+            self.assertEqual(m.get_intermediate_info('test3'), [1])
+
     def test_init(self):
         self.assertTrue(pwd_guess.ModelDefaults().context_length, 40)
         self.assertTrue(
@@ -502,6 +566,16 @@ class ModelDefaultsTest(unittest.TestCase):
             tfile.flush()
             self.assertListEqual(m.get_intermediate_info('test'), ['value2'])
 
+    def test_concurrent_mod_other_config(self):
+        with tempfile.NamedTemporaryFile(dir=TMPDIR) as tfile:
+            m = pwd_guess.ModelDefaults(intermediate_fname=tfile.name)
+            m.set_intermediate_info('test', ['value1'])
+            self.assertListEqual(m.get_intermediate_info('test'), ['value1'])
+            # Same size and no sleep, so the write may share our mtime
+            other = pwd_guess.ModelDefaults(intermediate_fname=tfile.name)
+            other.set_intermediate_info('test', ['value2'])
+            self.assertListEqual(m.get_intermediate_info('test'), ['value2'])
+
     def test_load_infer_type(self):
         with tempfile.NamedTemporaryFile(
                 dir=TMPDIR, suffix='.json', mode='w') as tfile:
@@ -853,7 +927,7 @@ class GuesserTest(unittest.TestCase):
                 answer.append([distribution.copy()])
             return answer
         mock_model = Mock()
-        mock_model.predict = smart_mock_predict
+        mock_model.predict_on_batch = smart_mock_predict
         return mock_model
 
     def make(self, config, distribution):
@@ -875,6 +949,70 @@ aa	0.125
 aaa	0.0625
 """, ostream.getvalue())
 
+    def test_next_nodes(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 3, char_bag = 'ab\n',
+            lower_probability_threshold = .2)
+        guesser, ostream = self.make(config, [0.5, 0.25, 0.25])
+        next_nodes = []
+        self.assertEqual(generator.expand_nodes(
+            guesser, [('aa', .8)], np.array([[[.5, .25, .25]]]),
+            next_nodes), 1)
+        self.assertEqual(next_nodes, [('aaa', .2), ('aab', .2)])
+        self.assertEqual(guesser.generated, 1)
+        next_nodes = []
+        generator.expand_nodes(
+            guesser, [('aaa', .8)], np.array([[[.5, .25, .25]]]), next_nodes)
+        self.assertEqual(next_nodes, [])
+        self.assertEqual(guesser.generated, 2)
+        self.assertEqual('aa\t0.4\naaa\t0.4\n', ostream.getvalue())
+
+    def test_next_nodes_many(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 3, char_bag = 'ab\n',
+            lower_probability_threshold = .2)
+        guesser, ostream = self.make(config, [0.5, 0.25, 0.25])
+        predictions = np.array([[[.5, .25, .25]], [[.1, .1, .8]]])
+        next_nodes = []
+        self.assertEqual(generator.expand_nodes(
+            guesser, [('aa', .8), ('ab', .5)], predictions, next_nodes), 2)
+        self.assertEqual(next_nodes, [('aaa', .2), ('aab', .2), ('abb', .4)])
+        self.assertEqual(guesser.generated, 1)
+        self.assertEqual('aa\t0.4\n', ostream.getvalue())
+
+    def test_next_nodes_max_children(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 3, char_bag = 'ab\n',
+            lower_probability_threshold = .2)
+        guesser, ostream = self.make(config, [0.5, 0.25, 0.25])
+        node_list = [('aa', .8), ('ab', .5)]
+        predictions = np.array([[[.5, .25, .25]], [[.1, .1, .8]]])
+        next_nodes = []
+        # Stops after the node that fills the batch, and never splits a node
+        self.assertEqual(generator.expand_nodes(
+            guesser, node_list, predictions, next_nodes, 0, 1), 1)
+        self.assertEqual(next_nodes, [('aaa', .2), ('aab', .2)])
+        self.assertEqual(generator.expand_nodes(
+            guesser, node_list, predictions, next_nodes, 1, 2), 1)
+        self.assertEqual(generator.expand_nodes(
+            guesser, node_list, predictions, next_nodes, 1, 3), 2)
+        self.assertEqual(next_nodes, [('aaa', .2), ('aab', .2), ('abb', .4)])
+
+    def test_guesser_node_order(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 3, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-3,
+            relevel_not_matching_passwords = False,
+            chunk_size_guesser = 6)
+        guesser, ostream = self.make(config, [0.5, 0.3, 0.2])
+        guesser.guess()
+        # 'bb' is expanded only after the batch filled by 'ba' is guessed,
+        # as when expanding node by node
+        self.assertEqual(
+            ['', 'a', 'b', 'aa', 'ab', 'ba', 'aaa', 'aab', 'aba', 'abb',
+             'baa', 'bab', 'bb', 'bba', 'bbb'],
+            [line.split('\t')[0] for line in ostream.getvalue().splitlines()])
+
     def test_guesser_small_batch(self):
         config = pwd_guess.ModelDefaults(
             min_len = 3, max_len = 3, char_bag = 'abcd\n',
@@ -884,6 +1022,50 @@ aaa	0.0625
         guesser, ostream = self.make(config, [0.5, 0.1, 0.1, 0.1, 0.2])
         guesser.guess()
 
+    def test_best_first_guesser(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 3, char_bag = 'ab\n',
+            lower_probability_threshold = 10**-3,
+            relevel_not_matching_passwords = False,
+            chunk_size_guesser = 2, guesser_class = 'best_first')
+        distribution = [0.5, 0.3, 0.2]
+        guesser, ostream = self.make(config, distribution)
+        guesser.guess()
+        expected = ostream.getvalue()
+        builder = pwd_guess.GuesserBuilder(config)
+        builder.add_model(self.mock_model(config, distribution))
+        ostream = io.StringIO()
+        builder.add_stream(ostream)
+        best_first = builder.build()
+        self.assertTrue(isinstance(best_first, pwd_guess.BestFirstGuesser))
+        best_first.guess()
+        self.assertEqual(sorted(expected.splitlines()),
+                         sorted(ostream.getvalue().splitlines()))
+
+    def test_best_first_guesser_batches(self):
+        config = pwd_guess.ModelDefaults(
+            min_len = 1, max_len = 3, char_bag = 'abc\n',
+            lower_probability_threshold = 10**-3,
+            relevel_not_matching_passwords = True,
+            chunk_size_guesser = 4)
+        def batch_sizes(guesser_class):
+            sizes = []
+            def recording_predict(str_list, **kwargs):
+                sizes.append(len(str_list))
+                return [[[0.4, 0.3, 0.2, 0.1]] for _ in str_list]
+            mock_model = Mock()
+            mock_model.predict_on_batch = recording_predict
+            ostream = io.StringIO()
+            guesser_class(mock_model, config, ostream).guess()
+            return sizes, sorted(ostream.getvalue().splitlines())
+        depth_first_sizes, expected = batch_sizes(pwd_guess.Guesser)
+        best_first_sizes, actual = batch_sizes(pwd_guess.BestFirstGuesser)
+        self.assertEqual(expected, actual)
+        # Prefixes of different lengths are predicted together, so once the
+        # frontier is large enough every batch is full
+        self.assertEqual(best_first_sizes, [1, 3] + [4] * 9)
+        self.assertEqual(depth_first_sizes, [1, 3] + [4] * 8 + [1, 3])
+
     def test_guesser_small_chunk(self):
         config = pwd_guess.ModelDefaults(
             min_len = 3, max_len = 3, char_bag = 'a\n',
@@ -921,7 +1103,7 @@ aaa	0.0625
             self.assertTrue(pwd_guess.Filterer(config).pwd_is_valid('aaa'))
             builder = pwd_guess.GuesserBuilder(config)
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel_skewed
+            mock_model.predict_on_batch = mock_predict_smart_parallel_skewed
             ostream = io.StringIO()
             builder.add_model(mock_model).add_stream(ostream)
             guesser = builder.build()
@@ -1014,7 +1196,7 @@ aaa	0.0625
                 guess_serialization_method = 'calculator',
                 password_test_fname = pwd_file.name)
             mock_model = Mock()
-            mock_model.predict = smart_mock_predict
+            mock_model.predict_on_batch = smart_mock_predict
             guesser = (pwd_guess.GuesserBuilder(config)
                        .add_model(mock_model).add_file(gfile.name).build())
             self.assertEqual(type(guesser.output_serializer),
@@ -1500,7 +1682,7 @@ class RandomWalkGuesserTest(unittest.TestCase):
             parallel_guessing = False,
             guess_serialization_method = 'random_walk'))
         mock_model = Mock()
-        mock_model.predict = mock_predict_smart_parallel
+        mock_model.predict_on_batch = mock_predict_smart_parallel
         builder.add_model(mock_model).add_file(self.tempf.name)
         guesser = builder.build()
         self.assertEqual(self.expected_class, type(guesser))
@@ -1513,7 +1695,7 @@ class RandomWalkGuesserTest(unittest.TestCase):
             guess_serialization_method = 'random_walk')
         builder = self.make_builder(config)
         mock_model = Mock()
-        mock_model.predict = mock_predict_smart_parallel
+        mock_model.predict_on_batch = mock_predict_smart_parallel
         builder.add_model(mock_model).add_file(self.tempf.name)
         guesser = builder.build()
         g = list(guesser.seed_data())
@@ -1526,7 +1708,7 @@ class RandomWalkGuesserTest(unittest.TestCase):
             guess_serialization_method = 'random_walk')
         builder = self.make_builder(config)
         mock_model = Mock()
-        mock_model.predict = mock_predict_smart_parallel
+        mock_model.predict_on_batch = mock_predict_smart_parallel
         builder.add_model(mock_model).add_file(self.tempf.name)
         guesser = builder.build()
         next = generator.next_nodes_random_walk(
@@ -1549,7 +1731,7 @@ class RandomWalkGuesserTest(unittest.TestCase):
             self.assertTrue(pwd_guess.Filterer(config).pwd_is_valid('aaa'))
             builder = self.make_builder(config)
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel_skewed
+            mock_model.predict_on_batch = mock_predict_smart_parallel_skewed
             builder.add_model(mock_model).add_file(self.tempf.name)
             guesser = builder.build()
             guesser.complete_guessing()
@@ -1567,6 +1749,39 @@ class RandomWalkGuesserTest(unittest.TestCase):
                         float(gn), 8 if pwd == 'aaa' else 1, delta = 2)
 
 
+    def test_relevel_rare_character_optimization(self):
+        with tempfile.NamedTemporaryFile(mode = 'w', dir=TMPDIR) as gf, \
+             tempfile.NamedTemporaryFile(dir=TMPDIR) as intermediatef:
+            gf.write('aaaa\n')
+            gf.flush()
+            config = pwd_guess.ModelDefaults(
+                parallel_guessing = False, char_bag = 'abAB\n', min_len = 3,
+                max_len = 5, password_test_fname = gf.name,
+                uppercase_character_optimization = True,
+                rare_character_optimization_guessing = True,
+                intermediate_fname = intermediatef.name,
+                relevel_not_matching_passwords = True,
+                guess_serialization_method = 'random_walk')
+            config.set_intermediate_info('rare_character_bag', [])
+            freqs = {
+                'a' : .4, 'b' : .4, 'A' : .1, 'B' : .1,
+            }
+            config.set_intermediate_info('character_frequencies', freqs)
+            config.set_intermediate_info(
+                'beginning_character_frequencies', freqs)
+            config.set_intermediate_info(
+                'end_character_frequencies', freqs)
+            builder = self.make_builder(config)
+            mock_model = Mock()
+            mock_model.predict_on_batch = mock_predict_smart_parallel_skewed
+            builder.add_model(mock_model).add_file(self.tempf.name)
+            guesser = builder.build()
+            np.testing.assert_array_almost_equal(
+                guesser.conditional_probs_many(['a', 'b']),
+                [[[0, 0.2, 0.8]], [[0, 0.2, 0.8]]])
+            np.testing.assert_array_almost_equal(
+                guesser.conditional_probs_many(['aaaab']), [[[1, 0, 0]]])
+
     @unittest.skipIf(not RUN_SLOW_TESTS, "skipping slow tests")
     def test_guess_simulated(self):
         with tempfile.NamedTemporaryFile(mode = 'w', dir=TMPDIR) as gf, \
@@ -1598,7 +1813,7 @@ class RandomWalkGuesserTest(unittest.TestCase):
             self.assertTrue(pwd_guess.Filterer(config).pwd_is_valid('aaa'))
             builder = self.make_builder(config)
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel_skewed
+            mock_model.predict_on_batch = mock_predict_smart_parallel_skewed
             builder.add_model(mock_model).add_file(self.tempf.name)
             guesser = builder.build()
             guesser.complete_guessing()
@@ -1626,7 +1841,7 @@ class RandomGeneratorTest(unittest.TestCase):
             relevel_not_matching_passwords = True,
             guess_serialization_method = 'generate_random')
         mock_model = Mock()
-        mock_model.predict = mock_predict_smart_parallel_skewed
+        mock_model.predict_on_batch = mock_predict_smart_parallel_skewed
         ostream = io.StringIO()
         builder = pwd_guess.GuesserBuilder(config)
         builder.add_model(mock_model)
@@ -1660,7 +1875,7 @@ class RandomGeneratorTest(unittest.TestCase):
                 relevel_not_matching_passwords = True,
                 guess_serialization_method = 'generate_random')
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel_skewed
+            mock_model.predict_on_batch = mock_predict_smart_parallel_skewed
             ostream = io.StringIO()
             builder = pwd_guess.GuesserBuilder(config)
             builder.add_model(mock_model)
@@ -1710,7 +1925,7 @@ class DelAmicoRandomWalkTest(RandomWalkGuesserTest):
                 password_test_fname = pwdfile.name,
                 guess_serialization_method = 'random_walk'))
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel
+            mock_model.predict_on_batch = mock_predict_smart_parallel
             builder.add_model(mock_model).add_file(self.tempf.name)
             guesser = builder.build()
             self.assertEqual(self.expected_class, type(guesser))
@@ -1726,7 +1941,7 @@ class DelAmicoRandomWalkTest(RandomWalkGuesserTest):
                 guess_serialization_method = 'random_walk')
             builder = self.make_builder(config)
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel
+            mock_model.predict_on_batch = mock_predict_smart_parallel
             builder.add_model(mock_model).add_file(self.tempf.name)
             guesser = builder.build()
             g = list(guesser.seed_data())
@@ -1743,7 +1958,7 @@ class DelAmicoRandomWalkTest(RandomWalkGuesserTest):
                 guess_serialization_method = 'random_walk')
             builder = self.make_builder(config)
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel
+            mock_model.predict_on_batch = mock_predict_smart_parallel
             builder.add_model(mock_model).add_file(self.tempf.name)
             guesser = builder.build()
             next = generator.next_nodes_random_walk(
@@ -1783,7 +1998,7 @@ class DelAmicoRandomWalkTest(RandomWalkGuesserTest):
             self.assertTrue(pwd_guess.Filterer(config).pwd_is_valid('aaa'))
             builder = self.make_builder(config)
             mock_model = Mock()
-            mock_model.predict = mock_predict_smart_parallel_skewed
+            mock_model.predict_on_batch = mock_predict_smart_parallel_skewed
             builder.add_model(mock_model).add_file(self.tempf.name)
             guesser = builder.build()
             guesser.complete_guessing()
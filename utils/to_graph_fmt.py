@@ -3,27 +3,35 @@
 import sys
 import argparse
 import csv
+import locale
 import os
 
 def main(args):
-    pwds = list([line.rstrip(os.linesep) for line in args.password_list])
+    # Both inputs are read as bytes so that guess number rows which are not
+    # in the password list never need to be decoded
+    encoding = locale.getpreferredencoding(False)
+    pwds = list([line.rstrip(b'\r\n') for line in args.password_list])
+    pwd_set = frozenset(pwds)
     ofile = open(os.path.join(
         args.output_dir, 'lookupresults.' + args.name), 'w')
     writer = csv.writer(ofile, delimiter='\t', quotechar=None)
     max_gn = 0
     guess_numbers = {}
-    for row in csv.reader(args.guess_numbers, delimiter='\t', quotechar=None):
+    for line in args.guess_numbers:
+        row = line.rstrip(b'\r\n').split(b'\t')
         if len(row) == 6:
             pwd, prob_str, guess_number, var, num, confidence = row
         elif len(row) == 2:
             pwd, guess_number = row
             prob_str, var, num, confidence = '0.1337', 0, 1, 0
         else:
+            row = [field.decode(encoding) for field in row]
             sys.stderr.write('Error, expected 2 or 6 rows and found %d %s\n' %
                              (len(row), str(row)))
             continue
-        if pwd not in pwds:
+        if pwd not in pwd_set:
             continue
+        guess_number = guess_number.decode(encoding)
         try:
             guess_number_round = int(round(float(guess_number), 0))
         except ValueError:
@@ -40,11 +48,11 @@ def main(args):
         max_gn = max(max_gn, guess_number_round)
     for pwd in pwds:
         if pwd in guess_numbers:
-            writer.writerow(['no_user', args.name, pwd,
+            writer.writerow(['no_user', args.name, pwd.decode(encoding),
                              guess_numbers[pwd][0], '0x0.1p-1',
                              guess_numbers[pwd][1], 'WRGOMI'])
         else:
-            writer.writerow(['no_user', args.name, pwd,
+            writer.writerow(['no_user', args.name, pwd.decode(encoding),
                              -1, '0x0.1p-1',
                              -1, 'WRGOMI'])
     ofile.close()
@@ -54,8 +62,8 @@ def main(args):
 
 if __name__=='__main__':
     parser = argparse.ArgumentParser(description='convert to graphing format')
-    parser.add_argument('password_list', type = argparse.FileType('r'))
-    parser.add_argument('guess_numbers', type = argparse.FileType('r'))
+    parser.add_argument('password_list', type = argparse.FileType('rb'))
+    parser.add_argument('guess_numbers', type = argparse.FileType('rb'))
     parser.add_argument('name')
     parser.add_argument('-o', '--output-dir', default='./')
     main(parser.parse_args())